@@ -2,28 +2,56 @@
 """
 通过图像分析检测PK场景
 PK场景特征：上下黑边
-依赖: Pillow (pip3 install pillow)
+依赖: NumPy (pip3 install numpy)
 """
 
-from PIL import Image
+import numpy as np
+import hashlib
+import json
 import os
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-import mimetypes
 
-def get_video_duration(video_path):
-    """获取视频时长（秒）"""
+# ffmpeg 截图时直接缩小为 1/4 尺寸的灰度图，Python 端无需再解码、缩放
+THUMBNAIL_FILTER = 'scale=iw/4:ih/4,format=gray'
+
+# 支持检测的视频文件扩展名
+_VIDEO_EXT = frozenset({'.flv', '.mp4', '.mkv', '.mov', '.webm', '.ts', '.m4v'})
+
+# 检测结果缓存文件，按视频内容指纹索引，重复运行时跳过已检测过的视频
+VERDICT_CACHE_FILE = os.path.expanduser('~/.cache/pk_detect.json')
+
+# ffprobe 结果缓存，按视频路径索引
+_probe_cache = {}
+
+def probe_video(video_path):
+    """
+    使用单次 ffprobe 调用(JSON输出)获取视频信息，结果按路径缓存
+    返回: {'duration': 时长（秒），获取失败为 None}
+    """
+    key = str(video_path)
+    if key in _probe_cache:
+        return _probe_cache[key]
+
     result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-         '-of', 'default=noprint_wrappers=1:nokey=1', video_path],
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', video_path],
         capture_output=True, text=True
     )
     try:
-        duration = float(result.stdout.strip())
-        return duration
-    except:
-        return None
+        duration = float(json.loads(result.stdout)['format']['duration'])
+    except (ValueError, KeyError, TypeError):
+        duration = None
+
+    info = {'duration': duration}
+    _probe_cache[key] = info
+    return info
+
+def get_video_duration(video_path):
+    """获取视频时长（秒）"""
+    return probe_video(video_path)['duration']
 
 def format_duration(seconds):
     """将秒数格式化为可读的时间字符串"""
@@ -39,102 +67,106 @@ def format_duration(seconds):
 
 
 def is_video_file(file_path):
-    """使用 mimetypes 检测文件类型"""
-    mime_type, _ = mimetypes.guess_type(str(file_path))
-    return mime_type is not None and mime_type.startswith('video/')
+    """按扩展名判断是否为视频文件"""
+    return file_path.suffix.lower() in _VIDEO_EXT
+
+def read_pgm_frame(stream):
+    """
+    从二进制流中读取一帧PGM(P5)灰度图，返回 (h, w) uint8 数组
+    流已结束或数据不完整时返回 None
+    """
+    # 头部为空白分隔的 4 个字段：P5 宽 高 最大灰度值，之后紧跟一个空白字符和像素数据
+    fields = []
+    field = b''
+    while len(fields) < 4:
+        c = stream.read(1)
+        if not c:
+            return None
+        if c.isspace():
+            if field:
+                fields.append(field)
+                field = b''
+        else:
+            field += c
 
-def get_gray_array(img):
-    """将图片转为灰度数组"""
-    gray = img.convert('L')
-    return list(gray.getdata())
+    if fields[0] != b'P5':
+        raise ValueError(f"不支持的PGM格式: {fields[0]!r}")
+
+    w, h = int(fields[1]), int(fields[2])
+    data = stream.read(w * h)
+    if len(data) < w * h:
+        return None
+    return np.frombuffer(data, dtype=np.uint8).reshape(h, w)
 
-def detect_split_screen(image_path):
+
+def compute_row_features(thumb):
+    """
+    一次性计算缩略图的逐行统计量，供亮度过滤、填充块检测和分割线检测共用
+    返回: {'row_mean': 每行亮度均值, 'row_var': 每行亮度方差}
+    """
+    # 方差按 E[X²] - E[X]² 单次遍历计算，判断时直接与阈值平方比较，省去开方
+    # 像素和与平方和使用整数累加（uint8 平方不超过 uint32），只有逐行结果才转为浮点
+    tw = thumb.shape[1]
+    pixels = thumb.astype(np.uint32)
+    row_sum = pixels.sum(axis=1, dtype=np.int64)
+    row_sq_sum = (pixels * pixels).sum(axis=1, dtype=np.int64)
+    row_mean = row_sum / tw
+    row_var = (row_sq_sum * tw - row_sum * row_sum) / (tw * tw)
+    return {'row_mean': row_mean, 'row_var': row_var}
+
+
+def detect_split_screen(thumb):
     """
-    检测图片是否存在PK场景
+    检测灰度缩略图是否存在PK场景
     PK视频特征：1:1正方形画面在9:16竖屏设备上播放时，上下会有单色填充块
     返回: (是否PK, 0)
     """
-    try:
-        img = Image.open(image_path)
-    except Exception:
-        return False, 0
-
-    w, h = img.size
-    gray_data = get_gray_array(img)
+    th = thumb.shape[0]
 
     # 跳过纯黑/过暗的画面（开场黑屏等）
-    avg_brightness = sum(gray_data) / len(gray_data)
-    if avg_brightness < 20:
+    # 只是粗略过滤，按 4x4 间隔抽样约 1/16 的像素估算亮度，过暗的画面无需计算逐行统计量
+    if thumb[::4, ::4].mean() < 20:
         return False, 0
 
+    features = compute_row_features(thumb)
+
     # 检测上下单色填充块（像素变化很小）
-    # 使用缩略图加速计算
-    thumb = img.resize((w // 4, h // 4)).convert('L')
-    thumb_data = list(thumb.getdata())
-    tw, th = w // 4, h // 4
-
-    # 检测上填充块
-    top_fill = 0
-    top_end_y = 0  # 记录上填充块的结束位置
-    for y in range(th):
-        row = thumb_data[y * tw:(y + 1) * tw]
-        row_avg = sum(row) / len(row)
-        row_std = (sum((x - row_avg) ** 2 for x in row) / len(row)) ** 0.5
-        if row_std < 10:  # 颜色均匀
-            top_fill += 1
-            top_end_y = y
-        else:
-            break
-
-    # 检测下填充块
-    bottom_fill = 0
-    bottom_start_y = th  # 记录下填充块的开始位置
-    for y in range(th - 1, -1, -1):
-        row = thumb_data[y * tw:(y + 1) * tw]
-        row_avg = sum(row) / len(row)
-        row_std = (sum((x - row_avg) ** 2 for x in row) / len(row)) ** 0.5
-        if row_std < 10:
-            bottom_fill += 1
-            bottom_start_y = y
-        else:
-            break
+    # 逐行标准差小于10（方差小于100，颜色均匀）的行视为填充块
+    uniform = features['row_var'] < 100
+    if uniform.all():
+        top_fill = bottom_fill = th
+    else:
+        top_fill = int(np.argmax(~uniform))
+        bottom_fill = int(np.argmax(~uniform[::-1]))
+    bottom_start_y = th - bottom_fill  # 下填充块的开始位置
 
     total_fill = top_fill + bottom_fill
     fill_ratio = total_fill / th
 
     # 判定PK：上下填充块占比超过15% 且有明显的水平分割线
     if fill_ratio > 0.15 and top_fill > 0 and bottom_fill > 0:
-        if check_horizontal_split_line(thumb_data, tw, th, top_fill, bottom_start_y):
+        if check_horizontal_split_line(features['row_mean'], top_fill, bottom_start_y):
             return True, 0
         return False, 0
 
     return False, 0
 
 
-def check_horizontal_split_line(gray_data, w, h, top_fill, bottom_start_y):
+def check_horizontal_split_line(row_mean, top_fill, bottom_start_y):
     """
     检测上下纯色块与中间内容区域之间是否有明显的水平分割线
     PK场景中，纯色填充块和正常画面之间应该有明显的边界
+    row_mean: 缩略图逐行亮度均值
     """
+    h = len(row_mean)
     if h < 4 or top_fill >= h or bottom_start_y <= 0:
         return False
 
     # 检查上分割线：上填充块的最后一行与中间内容的第一行之间
-    top_line_y = top_fill - 1
-    top_fill_row = gray_data[top_line_y * w:(top_line_y + 1) * w]
-    content_row = gray_data[(top_fill) * w:(top_fill + 1) * w]
-
-    top_fill_avg = sum(top_fill_row) / len(top_fill_row)
-    content_avg = sum(content_row) / len(content_row)
-    top_diff = abs(top_fill_avg - content_avg)
+    top_diff = abs(row_mean[top_fill - 1] - row_mean[top_fill])
 
     # 检查下分割线：中间内容的最后一行与下填充块的第一行之间
-    content_bottom_row = gray_data[(bottom_start_y - 1) * w:bottom_start_y * w]
-    bottom_fill_row = gray_data[bottom_start_y * w:(bottom_start_y + 1) * w]
-
-    content_bottom_avg = sum(content_bottom_row) / len(content_bottom_row)
-    bottom_fill_avg = sum(bottom_fill_row) / len(bottom_fill_row)
-    bottom_diff = abs(content_bottom_avg - bottom_fill_avg)
+    bottom_diff = abs(row_mean[bottom_start_y - 1] - row_mean[bottom_start_y])
 
     # PK场景判定：上下都有明显的分割线（亮度差异明显）
     # 放宽条件：如果某个分割线非常明显(>60)，另一个只要>25即可
@@ -143,138 +175,171 @@ def check_horizontal_split_line(gray_data, w, h, top_fill, bottom_start_y):
            (bottom_diff > 60 and top_diff > 25)
 
 
-def extract_frames(video_path, output_dir, num_frames=6):
-    """使用ffmpeg从视频中提取帧截图"""
-    os.makedirs(output_dir, exist_ok=True)
-
-    print(f"从视频提取截图: {video_path}")
-
-    # 获取视频时长
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-         '-of', 'default=noprint_wrappers=1:nokey=1', video_path],
-        capture_output=True, text=True
+def _read_frame_stream(cmd):
+    """运行输出PGM流的ffmpeg命令，逐帧产出灰度缩略图，返回 (读取到的帧数, ffmpeg返回码)"""
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
     )
+    count = 0
     try:
-        duration = float(result.stdout.strip())
-    except:
+        while True:
+            thumb = read_pgm_frame(proc.stdout)
+            if thumb is None:
+                break
+            count += 1
+            yield thumb
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    return count, proc.returncode
+
+
+def extract_frames(video_path, num_frames=6, log=print, hwaccel=False):
+    """
+    使用ffmpeg从视频中均匀提取帧，逐帧产出灰度缩略图数组
+    所有采样帧由单个ffmpeg进程以PGM流的形式写入管道，不落盘；
+    调用方检测已到达的帧时，ffmpeg可以同时解码后续的帧
+    hwaccel: 为True时让ffmpeg自动选择可用的硬件解码器（NVDEC/VAAPI/VideoToolbox等），
+             不可用时自动回退到软件解码
+    """
+    log(f"从视频提取截图: {video_path}")
+
+    # 获取视频时长
+    duration = get_video_duration(video_path)
+    if duration is None:
         duration = 60
 
     # 均匀采样，确保timestamp不超出视频时长
     interval = max(1, int(duration / num_frames))
-    screenshots = []
-
-    for i in range(num_frames):
-        timestamp = min(i * interval, duration - 0.1)
-        output_path = os.path.join(output_dir, f"frame_{i:03d}.jpg")
-        cmd = [
-            'ffmpeg',
-            '-ss', str(timestamp),
-            '-i', video_path,
-            '-frames:v', '1',
-            '-q:v', '10',
-            '-y', output_path
-        ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        if os.path.exists(output_path):
-            screenshots.append(output_path)
-            print(f"  提取帧 {i+1}/{num_frames}: {timestamp}s -> frame_{i:03d}.jpg")
-        elif i == 0:
-            # 如果第一帧就失败，尝试用select滤镜提取第一帧
-            cmd_select = [
+    timestamps = [min(i * interval, duration - 0.1) for i in range(num_frames)]
+
+    input_opts = ['-hwaccel', 'auto'] if hwaccel else []
+    output_opts = ['-vsync', '0', '-f', 'image2pipe', '-c:v', 'pgm', 'pipe:1']
+
+    # 单个ffmpeg进程完成所有截图：每个采样点作为一路独立seek的输入，
+    # 各取一帧缩小为灰度图后按顺序拼接成一路输出
+    cmd = ['ffmpeg']
+    filters = []
+    for i, timestamp in enumerate(timestamps):
+        cmd += input_opts + ['-ss', str(timestamp), '-i', video_path]
+        filters.append(f'[{i}:v]trim=end_frame=1,setpts=PTS-STARTPTS,{THUMBNAIL_FILTER},setsar=1[f{i}]')
+    labels = ''.join(f'[f{i}]' for i in range(num_frames))
+    filters.append(f'{labels}concat=n={num_frames}:v=1:a=0[v]')
+    cmd += ['-filter_complex', ';'.join(filters), '-map', '[v]'] + output_opts
+
+    count, returncode = yield from _read_frame_stream(cmd)
+
+    if returncode != 0 and count < num_frames:
+        # concat 要求各路输入尺寸一致，视频中途分辨率变化时拼接会失败；
+        # 已输出的帧按顺序对应前 count 个采样点，其余采样点逐个单独提取
+        log(f"  拼接输出失败（如各采样点分辨率不一致），逐个提取剩余 {num_frames - count} 帧")
+        for timestamp in timestamps[count:]:
+            cmd_single = [
                 'ffmpeg',
+                *input_opts,
+                '-ss', str(timestamp),
                 '-i', video_path,
-                '-vf', 'select=eq(n\\,0)',
+                '-vf', THUMBNAIL_FILTER,
                 '-frames:v', '1',
-                '-q:v', '10',
-                '-y', output_path
+                *output_opts
             ]
-            subprocess.run(cmd_select, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            if os.path.exists(output_path):
-                screenshots.append(output_path)
-                print(f"  提取帧 1/1: 0s -> frame_000.jpg (备用方法)")
-
-    return screenshots
-
-
-def check_pk_in_video(video_path, num_frames=6):
-    """检测视频中是否包含PK场景"""
-    output_dir = "/tmp/pk_screenshots"
+            extracted, _ = yield from _read_frame_stream(cmd_single)
+            count += extracted
 
-    # 提取截图
-    screenshots = extract_frames(video_path, output_dir, num_frames)
+    if count == 0:
+        # 如果一帧都没有提取到，尝试用select滤镜提取第一帧
+        log("  截图失败，尝试提取第一帧 (备用方法)")
+        cmd_select = [
+            'ffmpeg',
+            *input_opts,
+            '-i', video_path,
+            '-vf', f'select=eq(n\\,0),{THUMBNAIL_FILTER}',
+            '-frames:v', '1',
+            *output_opts
+        ]
+        yield from _read_frame_stream(cmd_select)
 
-    if not screenshots:
-        print("无法提取视频帧")
-        return
 
-    # print(f"\n检测 {len(screenshots)} 张截图...\n")
+def check_pk_in_video(video_path, num_frames=6, log=print, hwaccel=False):
+    """
+    检测视频中是否包含PK场景
 
+    Args:
+        video_path: 视频文件路径
+        num_frames: 采样帧数
+        log: 日志输出函数
+        hwaccel: 是否尝试使用硬件解码
+    """
     pk_count = 0
+    frame_count = 0
 
-    for img_path in screenshots:
-        is_split, pos = detect_split_screen(img_path)
+    # 边提取边检测
+    for thumb in extract_frames(video_path, num_frames, log, hwaccel):
+        is_split, pos = detect_split_screen(thumb)
 
         if is_split:
             pk_count += 1
-            print(f"[PK]   {os.path.basename(img_path)}")
+            log(f"[PK]   frame_{frame_count:03d}")
         else:
-            print(f"[OK]   {os.path.basename(img_path)}")
+            log(f"[OK]   frame_{frame_count:03d}")
+        frame_count += 1
 
-    print(f"\n{'='*50}")
-    print(f"总结: {pk_count}/{len(screenshots)} 张截图检测到PK分屏结构")
+    if not frame_count:
+        log("无法提取视频帧")
+        return
+
+    log(f"\n{'='*50}")
+    log(f"总结: {pk_count}/{frame_count} 张截图检测到PK分屏结构")
 
-    is_pk = pk_count > len(screenshots) * 0.3
+    is_pk = pk_count > frame_count * 0.3
 
     if is_pk:
-        print(f"结论: {video_path} 包含PK场景")
+        log(f"结论: {video_path} 包含PK场景")
     else:
-        print(f"结论: {video_path} 不包含PK场景（普通直播）")
-
-    # 清理临时文件
-    for f in screenshots:
-        os.remove(f)
-    os.rmdir(output_dir)
+        log(f"结论: {video_path} 不包含PK场景（普通直播）")
 
     return is_pk
 
 
-def check_pk_in_screenshots(screenshot_dir):
-    """检测目录下所有截图是否存在PK分屏"""
-    path = Path(screenshot_dir)
-    images = sorted(path.glob("*.jpg")) + sorted(path.glob("*.png"))
+def video_fingerprint(video_path):
+    """以文件大小 + 前1MB内容的哈希作为视频指纹，用于识别重复（改名、重复上传）的视频"""
+    with open(video_path, 'rb') as f:
+        digest = hashlib.blake2b(f.read(1 << 20), digest_size=16).hexdigest()
+    return f"{os.path.getsize(video_path)}:{digest}"
 
-    if not images:
-        print(f"未找到截图文件: {screenshot_dir}")
-        return
 
-    print(f"检测 {len(images)} 张截图...\n")
+def load_verdict_cache():
+    """读取检测结果缓存，文件不存在或损坏时返回空缓存"""
+    try:
+        with open(VERDICT_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    pk_count = 0
 
-    for img_path in images:
-        is_split, pos = detect_split_screen(str(img_path))
+def save_verdict_cache(cache):
+    """保存检测结果缓存，写入失败不影响检测流程"""
+    try:
+        os.makedirs(os.path.dirname(VERDICT_CACHE_FILE), exist_ok=True)
+        with open(VERDICT_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
 
-        if is_split:
-            pk_count += 1
-            print(f"[PK]   {img_path.name}")
-        else:
-            print(f"[OK]   {img_path.name}")
 
-    print(f"\n{'='*50}")
-    print(f"总结: {pk_count}/{len(images)} 张截图检测到PK分屏结构")
+def _check_pk_worker(video_path, num_frames, hwaccel):
+    """进程池任务：检测单个视频，日志收集后交由主进程统一输出"""
+    logs = []
+    is_pk = check_pk_in_video(video_path, num_frames, logs.append, hwaccel)
+    return video_path, is_pk, logs, probe_video(video_path)
 
-    if pk_count > len(images) * 0.3:
-        print("结论: 该视频包含PK场景")
-    else:
-        print("结论: 该视频不包含PK场景（普通直播）")
 
-
-def check_and_delete_pk_videos(directory, num_frames=6, dry_run=True):
+def check_and_delete_pk_videos(directory, num_frames=6, dry_run=True, hwaccel=False):
     """检测目录下所有视频，删除包含PK场景的文件"""
     dir_path = Path(directory)
-    # videos = sorted(dir_path.glob("*.flv"))
     videos = sorted(
         p for p in dir_path.iterdir() 
         if is_video_file(p)
@@ -289,16 +354,45 @@ def check_and_delete_pk_videos(directory, num_frames=6, dry_run=True):
     pk_files = []
     non_pk_files = []
 
+    # 相同内容（指纹相同）的视频只检测一次，已缓存结果的视频不再检测
+    # 采样帧数不同结论可能不同，一并作为缓存键
+    cache = load_verdict_cache()
+    keys = {video_path: f"{video_fingerprint(video_path)}:{num_frames}" for video_path in videos}
+    pending = {}
     for video_path in videos:
-        print(f"检查: {video_path.name}")
-        is_pk = check_pk_in_video(video_path, num_frames)
+        if keys[video_path] not in cache:
+            pending.setdefault(keys[video_path], video_path)
 
-        if is_pk:
-            pk_files.append(video_path)
-            print(f"  -> 包含PK场景，将删除")
-        else:
-            non_pk_files.append(video_path)
-            print(f"  -> 普通直播，保留")
+    # 各视频的检测互不依赖，使用多进程并行处理，按原顺序输出结果
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(_check_pk_worker, pending.values(), repeat(num_frames), repeat(hwaccel))
+
+        for video_path in videos:
+            key = keys[video_path]
+            print(f"检查: {video_path.name}")
+
+            if pending.get(key) == video_path:
+                _, is_pk, logs, info = next(results)
+                # 复用子进程的 ffprobe 结果，后续列出待删除文件时无需再次探测
+                _probe_cache[str(video_path)] = info
+
+                for line in logs:
+                    print(line)
+
+                if is_pk is not None:
+                    cache[key] = is_pk
+            else:
+                is_pk = cache.get(key)
+                print("  相同内容的视频已检测过，复用检测结果")
+
+            if is_pk:
+                pk_files.append(video_path)
+                print(f"  -> 包含PK场景，将删除")
+            else:
+                non_pk_files.append(video_path)
+                print(f"  -> 普通直播，保留")
+
+    save_verdict_cache(cache)
 
     print(f"\n{'='*50}")
     print(f"总结: {len(pk_files)}/{len(videos)} 个文件包含PK场景")
@@ -326,19 +420,16 @@ if __name__ == "__main__":
         print("用法:")
         print("  检测并删除:     python3 check_pk.py /path/to/dir")
         print("  仅预览不删除:   python3 check_pk.py /path/to/dir --dry-run")
-        # print("  指定帧数:       python3 check_pk.py /path/to/dir 10")
+        print("  使用硬件解码:   python3 check_pk.py /path/to/dir --hwaccel")
         sys.exit(1)
 
     directory = sys.argv[1]
     dry_run = '--dry-run' in sys.argv
+    hwaccel = '--hwaccel' in sys.argv
     num_frames = 2
 
-    # for arg in sys.argv[2:]:
-    #     if arg.isdigit():
-    #         num_frames = int(arg)
-
     if not os.path.isdir(directory):
         print(f"目录不存在: {directory}")
         sys.exit(1)
 
-    check_and_delete_pk_videos(directory, num_frames, dry_run)
+    check_and_delete_pk_videos(directory, num_frames, dry_run, hwaccel)
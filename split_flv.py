@@ -5,9 +5,46 @@ FLV 文件分割脚本
 并自动修复时间戳偏移问题
 """
 
+import array
+import mmap
 import os
 import struct
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl
+    fcntl = None
+
+# 预编译的 32 位大端整数解析器（Tag 时间戳、PreviousTagSize）
+_U32 = struct.Struct('>I')
+
+# 写给 ffmpeg 的 stdin 缓冲区与管道容量
+_PIPE_SIZE = 1 << 20
+
+
+def _enlarge_pipe(pipe):
+    """尽量把管道容量提升到 1MB（仅 Linux 支持），不支持或失败时保持系统默认"""
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, _PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _advise_sequential(f, mm):
+    """提示内核输入文件将被顺序读取（加大预读、及时回收已读页面），平台不支持时忽略"""
+    try:
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+
 
 def split_and_fix_flv(input_file, output_dir=None):
     """
@@ -22,27 +59,22 @@ def split_and_fix_flv(input_file, output_dir=None):
 
     os.makedirs(output_dir, exist_ok=True)
 
+    if os.path.getsize(input_file) < 13:
+        print("无效的FLV文件")
+        return
+
+    # 以只读内存映射方式访问输入文件，由操作系统按需分页读取，避免把整个文件读入内存
+    # 下文中的 Tag 偏移均为文件内的绝对偏移
     with open(input_file, 'rb') as f:
         flv_header = f.read(9)
-        f.read(4)
-        all_data = f.read()
-
-    # 查找所有 Script Tag (type=18) 的位置
-    scripts = []
-    pos = 0
-    tag_count = 0
-
-    while pos + 11 <= len(all_data):
-        tag_type = all_data[pos]
-        data_size = struct.unpack('>I', bytes([0]) + all_data[pos+1:pos+4])[0]
+        all_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _advise_sequential(f, all_data)
+    mv = memoryview(all_data)
 
-        if tag_type == 18:
-            scripts.append({'tag': tag_count, 'offset': pos, 'size': data_size})
-
-        if pos + 11 + data_size + 4 > len(all_data):
-            break
-        pos += 11 + data_size + 4
-        tag_count += 1
+    # 一次遍历建立全部 Tag 的索引，同时找出所有 Script Tag (type=18) 和第一个片段中的 codec headers
+    # 修复时间戳时直接复用索引，不再重新遍历
+    index, scripts, avc_seq_header, aac_seq_header = index_tags(all_data)
+    tag_offsets = index[0]
 
     print(f"找到 {len(scripts)} 个 Script Tag")
 
@@ -52,173 +84,212 @@ def split_and_fix_flv(input_file, output_dir=None):
 
     base_name = os.path.splitext(os.path.basename(input_file))[0]
 
+    # 先确定各片段包含的 Tag 与输出文件
+    segment_tags = []
+    output_files = []
     for i, script in enumerate(scripts):
         # 片段范围：Script N 到 Script N+1（最后一个到文件结尾）
-        start = script['offset']
         if i < len(scripts) - 1:
-            end = scripts[i + 1]['offset']
+            end = scripts[i + 1]
         else:
-            end = len(all_data)
-
-        segment_data = bytearray(all_data[start:end])
+            end = len(tag_offsets)
 
         # 后续片段需要添加 AVC 和 AAC Sequence Header 才能被 ffmpeg 解析
+        # 按输出顺序排列组成该片段的各 Tag 序号
+        tags = array.array('Q')
         if i > 0:
-            search_start = scripts[0]['offset'] + 11 + scripts[0]['size'] + 4
-            search_end = scripts[1]['offset']
-            avc_seq_header = find_avc_sequence_header(all_data, search_start, search_end)
-            aac_seq_header = find_aac_sequence_header(all_data, search_start, search_end)
-            if avc_seq_header:
-                print(f"    包含 AVC Sequence Header")
-                segment_data = bytearray(avc_seq_header) + segment_data
-            if aac_seq_header:
-                print(f"    包含 AAC Audio Sequence Header")
-                segment_data = bytearray(aac_seq_header) + segment_data
-
-        # 修复时间戳偏移（跳过非关键帧，重写时间戳）
-        segment_data = fix_timestamps(segment_data, is_first_segment=(i == 0))
-
-        # 添加 FLV 头
-        segment_data = flv_header + struct.pack('>I', 0) + segment_data
-
-        output_file = os.path.join(output_dir, f"{base_name}_part{i+1}.flv")
-
-        # 通过 stdin 将 segment_data 输入给 ffmpeg
-        ffmpeg_cmd = [
-            'ffmpeg', '-y',
-            '-f', 'flv',          # 输入格式 flv
-            '-i', 'pipe:0',       # 从 stdin 读取
-            '-c', 'copy',
-            '-bsf:a', 'aac_adtstoasc',
-            output_file
-        ]
-
-        proc = subprocess.Popen(
-            ffmpeg_cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        proc.communicate(input=bytes(segment_data))
-
-        if proc.returncode == 0:
-            print(f"  片段 {i+1}: {output_file} ({len(segment_data)/1024/1024:.2f} MB)")
-        else:
-            print(f"  片段 {i+1} ffmpeg 处理失败，返回码: {proc.returncode}")
+            if aac_seq_header is not None:
+                tags.append(aac_seq_header)
+            if avc_seq_header is not None:
+                tags.append(avc_seq_header)
+        tags.extend(range(script, end))
+
+        segment_tags.append(tags)
+        output_files.append(os.path.join(output_dir, f"{base_name}_part{i+1}.flv"))
+
+    # 第一个片段保持原始数据和时间戳（与流式版本一致），直接原样写出；后续片段修复时间戳
+    fix = [i > 0 for i in range(len(scripts))]
+
+    # 各片段互不依赖，并行启动多个 ffmpeg 处理，按片段顺序输出结果
+    max_workers = min(len(scripts), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(write_segment, repeat(flv_header), repeat(mv), segment_tags,
+                               repeat(index), output_files, fix)
+
+        for i, (returncode, segment_size) in enumerate(results):
+            if i > 0:
+                if avc_seq_header is not None:
+                    print(f"    包含 AVC Sequence Header")
+                if aac_seq_header is not None:
+                    print(f"    包含 AAC Audio Sequence Header")
+
+            if returncode == 0:
+                print(f"  片段 {i+1}: {output_files[i]} ({segment_size/1024/1024:.2f} MB)")
+            else:
+                print(f"  片段 {i+1} ffmpeg 处理失败，返回码: {returncode}")
 
     print(f"\n分割完成！输出目录: {output_dir}")
 
 
-def find_avc_sequence_header(all_data, start_pos, end_pos):
+def index_tags(all_data):
     """
-    在指定范围内查找 AVC Sequence Header
-    返回完整的 Tag 数据（包含 header + data + PreviousTagSize）
+    一次遍历整个文件的 Tag，建立索引，同时查找 Script Tag 和 codec headers
+    返回 (index, scripts, avc_seq_header, aac_seq_header)
+      index: (offsets, types, sizes)，各 Tag 的绝对偏移、类型和数据大小，按字段分别存放在紧凑的 array 中
+             文件末尾不完整的 Tag 同样记录，写出时按实际剩余数据截断
+      scripts: 所有 Script Tag 的 Tag 序号
+      avc_seq_header / aac_seq_header: 第一个片段（前两个 Script Tag 之间）中
+             AVC Sequence Header / AAC Audio Sequence Header 的 Tag 序号，未找到为 None
+    AAC: Tag type=8, SoundFormat=10 (AAC), AAC type=0
     """
-    pos = start_pos
-
-    while pos + 11 <= end_pos:
-        tag_type = all_data[pos]
-        data_size = struct.unpack('>I', bytes([0]) + all_data[pos+1:pos+4])[0]
-
-        # 查找视频帧
-        if tag_type == 9:
-            frame_info = all_data[pos + 11]
-            codec_id = frame_info & 0x0F
+    tag_offsets = array.array('Q')
+    tag_types = array.array('B')
+    tag_sizes = array.array('I')
+    scripts = []
+    avc_seq_header = None
+    aac_seq_header = None
 
-            # AVC Codec
-            if codec_id == 7:
-                # AVC type 在 offset 12
-                avc_type = all_data[pos + 12]
+    pos = 13  # 跳过 FLV Header(9) + PreviousTagSize0(4)
+    # 循环中频繁使用的长度与内置函数提前绑定为局部变量，减少逐 Tag 的属性/全局查找
+    file_size = len(all_data)
+    from_bytes = int.from_bytes
 
-                # Sequence Header
-                if avc_type == 0:
-                    # 包含：Tag Header (11) + Data + PreviousTagSize (4)
-                    tag_data = all_data[pos:pos + 11 + data_size + 4]
-                    return tag_data
+    while pos + 11 <= file_size:
+        tag_type = all_data[pos]
+        data_size = from_bytes(all_data[pos+1:pos+4], 'big')
 
+        if tag_type == 18:
+            scripts.append(len(tag_offsets))
+
+        # 第一个片段内查找 codec headers，AVC/AAC type 均在 offset 12，0 为 Sequence Header
+        elif len(scripts) == 1 and pos + 13 <= file_size:
+            # 视频帧：AVC Codec
+            if tag_type == 9 and avc_seq_header is None:
+                if all_data[pos + 11] & 0x0F == 7 and all_data[pos + 12] == 0:
+                    avc_seq_header = len(tag_offsets)
+
+            # 音频帧：AAC format = 10
+            elif tag_type == 8 and aac_seq_header is None:
+                if all_data[pos + 11] & 0xF0 == 0xA0 and all_data[pos + 12] == 0:
+                    aac_seq_header = len(tag_offsets)
+
+        tag_offsets.append(pos)
+        tag_types.append(tag_type)
+        tag_sizes.append(data_size)
         pos += 11 + data_size + 4
 
-    return None
+    return (tag_offsets, tag_types, tag_sizes), scripts, avc_seq_header, aac_seq_header
 
 
-def find_aac_sequence_header(all_data, start_pos, end_pos):
+def write_segment(flv_header, data, tags, index, output_file, fix=True):
     """
-    在指定范围内查找 AAC Audio Sequence Header
-    返回完整的 Tag 数据（包含 header + data + PreviousTagSize）
-    Tag type=8, SoundFormat=10 (AAC), AAC type=0
+    启动 ffmpeg，将修复时间戳后的片段通过 stdin 写入并封装为 output_file
+    fix 为 False 时不修复时间戳，将片段对应的连续数据原样写出（保留 Script Tag 和原始时间戳）
+    返回 (ffmpeg 返回码, 片段字节数)
     """
-    pos = start_pos
-
-    while pos + 11 <= end_pos:
-        tag_type = all_data[pos]
-        data_size = struct.unpack('>I', bytes([0]) + all_data[pos+1:pos+4])[0]
-
-        # 查找音频帧
-        if tag_type == 8:
-            sound_format = all_data[pos + 11] & 0xF0
-            # AAC format = 10
-            if sound_format == 0xA0:
-                # AAC type 在 offset 12
-                aac_type = all_data[pos + 12]
-                # Audio Sequence Header
-                if aac_type == 0:
-                    # 包含：Tag Header (11) + Data + PreviousTagSize (4)
-                    tag_data = all_data[pos:pos + 11 + data_size + 4]
-                    return tag_data
-
-        pos += 11 + data_size + 4
-
-    return None
-
-
-def fix_timestamps(data, is_first_segment=True):
+    # 通过 stdin 将片段数据输入给 ffmpeg
+    ffmpeg_cmd = [
+        'ffmpeg', '-y',
+        '-f', 'flv',          # 输入格式 flv
+        '-i', 'pipe:0',       # 从 stdin 读取
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',
+        output_file
+    ]
+
+    proc = subprocess.Popen(
+        ffmpeg_cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        bufsize=_PIPE_SIZE    # 大缓冲区合并逐 Tag 的小块写入，减少管道写系统调用
+    )
+    _enlarge_pipe(proc.stdin)
+
+    # 边修复边写入：FLV 头之后直接输出修复时间戳后的 Tag，不在内存中拼接整个片段
+    segment_size = 13
+    try:
+        proc.stdin.write(flv_header)
+        proc.stdin.write(_U32.pack(0))
+        if fix:
+            # 修复时间戳偏移（跳过非关键帧，重写时间戳）
+            segment_size += fix_timestamps(data, tags, index, proc.stdin.write)
+        else:
+            tag_offsets = index[0]
+            end_tag = tags[-1] + 1
+            end = tag_offsets[end_tag] if end_tag < len(tag_offsets) else len(data)
+            segment_size += proc.stdin.write(data[tag_offsets[tags[0]]:end])
+    except BrokenPipeError:
+        # ffmpeg 进程已提前结束，由返回码反映失败
+        pass
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    proc.wait()
+
+    return proc.returncode, segment_size
+
+
+def fix_timestamps(data, tags, index, write):
     """
-    修复 FLV 片段中的时间戳偏移
+    修复 FLV 片段中的时间戳偏移，修复后的 Tag 依次通过 write 输出
     FLV Tag Header: tag_type(1) + data_size(3) + timestamp(4) + stream_id(3)
-    返回修复后的数据
+    data: 输入文件数据
+    tags: 按输出顺序组成片段的 Tag 序号（codec headers、片段数据）
+    index: index_tags 建立的 Tag 索引，Tag 位置直接取自索引，无需重新遍历
+    返回写出的字节数
     """
-    pos = 0
-    output_data = bytearray()
-
-    # 收集所有帧的信息
-    frames = []
-    while pos + 11 <= len(data):
-        tag_type = data[pos]
-        data_size = struct.unpack('>I', bytes([0]) + data[pos+1:pos+4])[0]
-
-        if tag_type in [8, 9]:  # 音频或视频帧
-            timestamp = struct.unpack('>I', data[pos+4:pos+8])[0]
-            frames.append({
-                'type': tag_type,
-                'size': data_size,
-                'timestamp': timestamp,
-                'data': bytes(data[pos:pos + 11 + data_size])
-            })
-
-        if pos + 11 + data_size + 4 > len(data):
-            break
-        pos += 11 + data_size + 4
-
-    if not frames:
-        return data
-
-    # 找到第一个音视频帧中较小的时间戳作为基准
-    base_timestamp = min(f['timestamp'] for f in frames if f['type'] in [8, 9])
-
-    # 规范化所有帧的时间戳
-    for frame in frames:
-        new_ts = frame['timestamp'] - base_timestamp
+    tag_offsets, tag_types, tag_sizes = index
+
+    # 逐 Tag 循环中使用的方法绑定为局部变量，减少属性/全局查找
+    unpack_from = _U32.unpack_from
+    pack_into = _U32.pack_into
+    pack = _U32.pack
+
+    # 收集所有音视频帧的 Tag 序号与时间戳（按字段分别存放在紧凑的 array 中）
+    frames = array.array('Q')
+    frame_timestamps = array.array('I')
+    base_timestamp = None  # 扫描时同步记录最小的音视频帧时间戳作为基准
+    for tag in tags:
+        tag_type = tag_types[tag]
+        if tag_type == 8 or tag_type == 9:  # 音频或视频帧
+            timestamp = unpack_from(data, tag_offsets[tag] + 4)[0]
+            frames.append(tag)
+            frame_timestamps.append(timestamp)
+            if base_timestamp is None or timestamp < base_timestamp:
+                base_timestamp = timestamp
+
+    if base_timestamp is None:
+        # 没有音视频帧，原样输出
+        written = 0
+        for tag in tags:
+            offset = tag_offsets[tag]
+            written += write(data[offset:offset + 11 + tag_sizes[tag] + 4])
+        return written
+
+    # 规范化所有帧的时间戳，逐帧写出
+    # Tag 头部复用同一个缓冲区原地改写时间戳，Tag 数据直接引用原始数据，不做拷贝
+    written = 0
+    tag_header = bytearray(11)
+    for tag, timestamp in zip(frames, frame_timestamps):
+        new_ts = timestamp - base_timestamp
 
         # 确保时间戳非负
         if new_ts < 0:
             new_ts = 0
 
-        tag_data = bytearray(frame['data'])
-        tag_data[4:8] = struct.pack('>I', new_ts)
-        output_data.extend(tag_data)
-        output_data.extend(struct.pack('>I', 11 + frame['size']))
-
-    return bytes(output_data)
+        offset = tag_offsets[tag]
+        size = tag_sizes[tag]
+        tag_header[:] = data[offset:offset + 11]
+        pack_into(tag_header, 4, new_ts)
+        tag_body = data[offset + 11:offset + 11 + size]
+        write(tag_header)
+        write(tag_body)
+        write(pack(11 + size))
+        written += 11 + len(tag_body) + 4
+
+    return written
 
 
 if __name__ == "__main__":
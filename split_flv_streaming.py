@@ -6,9 +6,69 @@ FLV 文件流式分割脚本
 支持流式处理，避免大文件内存占用
 """
 
+import mmap
 import os
+import queue
 import struct
 import subprocess
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl
+    fcntl = None
+
+# 预编译的 32 位大端整数解析器（Tag 时间戳、PreviousTagSize）
+_U32 = struct.Struct('>I')
+
+# 写给 ffmpeg 的 stdin 缓冲区与管道容量
+_PIPE_SIZE = 1 << 20
+
+# 解析线程按批把 Tag 交给写入线程：每批的 Tag 数，以及队列中最多积压的批数
+_BATCH_TAGS = 64
+_QUEUE_SIZE = 256
+
+
+def _enlarge_pipe(pipe):
+    """尽量把管道容量提升到 1MB（仅 Linux 支持），不支持或失败时保持系统默认"""
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, _PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _advise_sequential(f, mm):
+    """提示内核输入文件将被顺序读取（加大预读、及时回收已读页面），平台不支持时忽略"""
+    try:
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+
+
+def _pipe_writer(stdin, write_queue, errors):
+    """
+    写入线程：把队列中的数据依次写入 ffmpeg stdin，收到 None 时结束
+    写入出错后不再写入，但继续取出剩余数据以免解析线程阻塞；
+    BrokenPipeError 表示 FFmpeg 进程已结束（由返回码反映失败），其它错误记录到 errors 交给主线程抛出
+    """
+    failed = False
+    while True:
+        batch = write_queue.get()
+        if batch is None:
+            return
+        if not failed:
+            try:
+                stdin.writelines(batch)
+            except BrokenPipeError:
+                failed = True
+            except Exception as e:
+                errors.append(e)
+                failed = True
 
 
 class StreamingFLVSplitter:
@@ -16,6 +76,9 @@ class StreamingFLVSplitter:
         self.input_file = input_file
         self.output_dir = output_dir or os.path.join(os.path.dirname(input_file), 'split_output')
         os.makedirs(self.output_dir, exist_ok=True)
+        # 输出文件名前缀只需计算一次，各片段按序号拼接
+        self._base_name = os.path.splitext(os.path.basename(input_file))[0]
+        self._out_prefix = os.path.join(self.output_dir, f"{self._base_name}_part")
 
         # 状态变量
         self.current_segment = 0
@@ -27,36 +90,53 @@ class StreamingFLVSplitter:
         self.current_output_file = None
         self.base_timestamp = None
         self.first_frame_in_segment = True
-
-    def read_tag_header(self, f):
-        """读取FLV Tag头部信息"""
-        header = f.read(11)
-        if len(header) < 11:
+        # FLV头(9) + PreviousTagSize0(4)，读取输入文件时缓存一次，每个片段直接写出
+        self._flv_prefix = None
+        # 写入线程及其队列，解析 Tag 与向 ffmpeg 写入并行进行
+        self._write_queue = None
+        self._writer_thread = None
+        self._writer_errors = []
+        self._batch = []
+
+    def read_tag_header(self, data, pos):
+        """
+        读取FLV Tag头部信息，data 为输入文件的 memoryview，pos 为 Tag 起始偏移
+        返回 (tag_type, data_size, timestamp, header)，数据不足时返回 None
+        """
+        if pos + 11 > len(data):
             return None
 
+        header = data[pos:pos + 11]
+
         tag_type = header[0]
-        data_size = struct.unpack('>I', bytes([0]) + header[1:4])[0]
-        timestamp = struct.unpack('>I', header[4:8])[0]
+        data_size = (header[1] << 16) | (header[2] << 8) | header[3]  # 24 位大端，直接按字节组合，不创建切片
+        timestamp = _U32.unpack_from(header, 4)[0]
 
-        return {
-            'tag_type': tag_type,
-            'data_size': data_size,
-            'timestamp': timestamp,
-            'header': header
-        }
+        return tag_type, data_size, timestamp, header
 
     def write_flv_header(self, proc):
         """写入FLV文件头"""
-        with open(self.input_file, 'rb') as f:
-            flv_header = f.read(9)
-            f.read(4)  # PreviousTagSize0
-            proc.stdin.write(flv_header)
-            proc.stdin.write(struct.pack('>I', 0))
+        proc.stdin.write(self._flv_prefix)
+
+    def stop_writer(self):
+        """提交尚未入队的数据，等待写入线程把当前段全部写完后退出"""
+        if self._writer_thread is None:
+            return
+        if self._batch:
+            self._write_queue.put(self._batch)
+            self._batch = []
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        # 写入线程中的非管道断开错误在主线程重新抛出
+        if self._writer_errors:
+            raise self._writer_errors.pop(0)
 
     def start_new_segment(self):
         """开始新段处理"""
         if self.ffmpeg_process:
-            # 结束当前段的FFmpeg进程
+            # 结束当前段的FFmpeg进程（写入线程的错误直接抛出，不被下面吞掉）
+            self.stop_writer()
             try:
                 self.ffmpeg_process.stdin.close()
                 self.ffmpeg_process.wait()
@@ -69,8 +149,7 @@ class StreamingFLVSplitter:
 
         # 准备新段
         self.current_segment += 1
-        base_name = os.path.splitext(os.path.basename(self.input_file))[0]
-        self.current_output_file = os.path.join(self.output_dir, f"{base_name}_part{self.current_segment}.flv")
+        self.current_output_file = f"{self._out_prefix}{self.current_segment}.flv"
 
         # 启动新的FFmpeg进程
         ffmpeg_cmd = [
@@ -86,8 +165,10 @@ class StreamingFLVSplitter:
             ffmpeg_cmd,
             stdin=subprocess.PIPE,
             stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+            stderr=subprocess.DEVNULL,
+            bufsize=_PIPE_SIZE    # 大缓冲区合并逐 Tag 的小块写入，减少管道写系统调用
         )
+        _enlarge_pipe(self.ffmpeg_process.stdin)
 
         # 写入FLV头
         self.write_flv_header(self.ffmpeg_process)
@@ -101,36 +182,48 @@ class StreamingFLVSplitter:
                 print(f"    包含 AAC Audio Sequence Header")
                 self.ffmpeg_process.stdin.write(self.aac_seq_header)
 
+        # 启动写入线程，之后的 Tag 经队列交给它写入 ffmpeg
+        self._write_queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        self._writer_thread = threading.Thread(
+            target=_pipe_writer,
+            args=(self.ffmpeg_process.stdin, self._write_queue, self._writer_errors),
+            daemon=True
+        )
+        self._writer_thread.start()
+
         self.base_timestamp = None
         self.first_frame_in_segment = True
 
-    def extract_codec_headers(self, full_tag_with_header, tag_type, frame_info):
-        """从第一个段中提取codec headers"""
+    def extract_codec_headers(self, header, tag_data, tag_type, frame_info):
+        """
+        从第一个段中提取codec headers
+        Tag 头部与数据分开传入，只有命中 Sequence Header 时才拼接成完整 Tag
+        """
         if self.codec_headers_extracted or self.current_segment != 1:
             return
 
-        data_size = len(full_tag_with_header) - 11  # 减去header长度
+        data_size = len(tag_data)
 
         # 查找AVC Sequence Header
         if tag_type == 9:  # 视频帧
             codec_id = frame_info & 0x0F
             if codec_id == 7:  # AVC Codec
                 if data_size > 1:  # 确保有足够的数据
-                    avc_type = full_tag_with_header[12]  # AVC type在offset 12
+                    avc_type = tag_data[1]  # AVC type在Tag offset 12
                     if avc_type == 0 and not self.avc_seq_header:  # Sequence Header
                         # 完整Tag数据: header + data + PreviousTagSize
                         previous_tag_size = struct.pack('>I', 11 + data_size)
-                        self.avc_seq_header = full_tag_with_header + previous_tag_size
+                        self.avc_seq_header = bytes(header) + tag_data + previous_tag_size
 
         # 查找AAC Audio Sequence Header
         elif tag_type == 8:  # 音频帧
             sound_format = frame_info & 0xF0
             if sound_format == 0xA0:  # AAC format
                 if data_size > 1:  # 确保有足够的数据
-                    aac_type = full_tag_with_header[12]  # AAC type在offset 12
+                    aac_type = tag_data[1]  # AAC type在Tag offset 12
                     if aac_type == 0 and not self.aac_seq_header:  # Audio Sequence Header
                         previous_tag_size = struct.pack('>I', 11 + data_size)
-                        self.aac_seq_header = full_tag_with_header + previous_tag_size
+                        self.aac_seq_header = bytes(header) + tag_data + previous_tag_size
 
         # 只有当我们确定已经处理了足够的数据后才标记为已提取
         # 这里我们不自动设置codec_headers_extracted，而是让外部逻辑控制
@@ -141,14 +234,14 @@ class StreamingFLVSplitter:
             # 暂时不自动设置，让外部逻辑在适当时机设置
             pass
 
-    def fix_timestamp_for_streaming(self, tag_header, timestamp):
+    def fix_timestamp_for_streaming(self, tag_type, timestamp):
         """流式修复时间戳"""
         if self.current_segment == 1:
             # 第一个段保持原始时间戳
             return timestamp
 
         # 找到段内第一个音视频帧的时间戳作为基准
-        if self.base_timestamp is None and tag_header['tag_type'] in [8, 9]:
+        if self.base_timestamp is None and tag_type in [8, 9]:
             self.base_timestamp = timestamp
 
         if self.base_timestamp is not None:
@@ -159,10 +252,8 @@ class StreamingFLVSplitter:
 
         return timestamp
 
-    def process_tag(self, tag_header, tag_data, previous_tag_size_data):
+    def process_tag(self, tag_type, data_size, original_timestamp, header, tag_data, previous_tag_size_data):
         """处理单个Tag"""
-        tag_type = tag_header['tag_type']
-        original_timestamp = tag_header['timestamp']
 
         # Script Tag检测 - 开始新段
         if tag_type == 18:
@@ -173,63 +264,73 @@ class StreamingFLVSplitter:
                     self.codec_headers_extracted = True
                 self.start_new_segment()
 
-        # 提取codec headers（仅在第一个段）
-        if self.current_segment == 1 and tag_type in [8, 9]:
+        # 提取codec headers（仅在第一个段，AVC/AAC 都已找到后不再检查）
+        if ((tag_type == 8 or tag_type == 9) and self.current_segment == 1
+                and (self.avc_seq_header is None or self.aac_seq_header is None)):
             frame_info = tag_data[0] if len(tag_data) > 0 else 0
-            full_tag_data = tag_header['header'] + tag_data
-            self.extract_codec_headers(full_tag_data, tag_type, frame_info)
+            self.extract_codec_headers(header, tag_data, tag_type, frame_info)
 
         # 修复时间戳
-        fixed_timestamp = self.fix_timestamp_for_streaming(tag_header, original_timestamp)
+        fixed_timestamp = self.fix_timestamp_for_streaming(tag_type, original_timestamp)
 
-        # 更新Tag头部的时间戳
-        new_header = bytearray(tag_header['header'])
-        new_header[4:8] = struct.pack('>I', fixed_timestamp)
+        # 更新Tag头部的时间戳（头部在写入线程写出前都要保持不变，每个 Tag 单独一份）
+        new_header = bytearray(header)
+        _U32.pack_into(new_header, 4, fixed_timestamp)
 
-        # 写入到当前FFmpeg进程
+        # 按批交给写入线程输出到当前FFmpeg进程
+        # Tag 数据是输入文件的 memoryview 切片，写出前保持有效
         if self.ffmpeg_process and self.ffmpeg_process.stdin:
-            try:
-                self.ffmpeg_process.stdin.write(new_header)
-                self.ffmpeg_process.stdin.write(tag_data)
-                self.ffmpeg_process.stdin.write(previous_tag_size_data)
-            except BrokenPipeError:
-                # FFmpeg进程已结束
-                pass
+            batch = self._batch
+            batch.append(new_header)
+            batch.append(tag_data)
+            batch.append(previous_tag_size_data)
+            if len(batch) >= _BATCH_TAGS * 3:
+                self._write_queue.put(batch)
+                self._batch = []
 
     def split_and_fix_flv(self):
         """流式分割和修复FLV文件"""
         print("开始流式处理FLV文件...")
 
-        # 开始第一个段
-        self.start_new_segment()
-
         with open(self.input_file, 'rb') as f:
-            # 跳过FLV头
+            # 读取FLV头
             flv_header = f.read(9)
             if len(flv_header) < 9:
                 print("无效的FLV文件")
                 return
 
             f.read(4)  # PreviousTagSize0
+            self._flv_prefix = flv_header + _U32.pack(0)
+
+            # 开始第一个段
+            self.start_new_segment()
+
+            # 以只读内存映射方式访问输入文件，按偏移切片取出各 Tag，由操作系统按需分页读取
+            # 避免每个 Tag 三次 read 调用及其产生的中间 bytes 对象
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _advise_sequential(f, mm)
+            data = memoryview(mm)
+            file_size = len(data)
+            pos = 13  # 跳过 FLV Header(9) + PreviousTagSize0(4)
 
             tag_count = 0
             while True:
-                tag_header = self.read_tag_header(f)
+                tag_header = self.read_tag_header(data, pos)
                 if tag_header is None:
                     break
 
-                # 读取Tag数据
-                tag_data = f.read(tag_header['data_size'])
-                if len(tag_data) < tag_header['data_size']:
+                # Tag数据及其后的PreviousTagSize不完整时结束
+                tag_type, data_size, timestamp, header = tag_header
+                data_end = pos + 11 + data_size
+                if data_end + 4 > file_size:
                     break
 
-                # 读取PreviousTagSize
-                previous_tag_size_data = f.read(4)
-                if len(previous_tag_size_data) < 4:
-                    break
+                tag_data = data[pos + 11:data_end]
+                previous_tag_size_data = data[data_end:data_end + 4]
 
                 # 处理Tag
-                self.process_tag(tag_header, tag_data, previous_tag_size_data)
+                self.process_tag(tag_type, data_size, timestamp, header, tag_data, previous_tag_size_data)
+                pos = data_end + 4
                 tag_count += 1
 
                 # 定期刷新输出（可选）
@@ -238,6 +339,7 @@ class StreamingFLVSplitter:
 
         # 结束最后一个段
         if self.ffmpeg_process:
+            self.stop_writer()
             try:
                 self.ffmpeg_process.stdin.close()
                 self.ffmpeg_process.wait()